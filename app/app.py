@@ -10,13 +10,23 @@ Set these in app.yaml - see SETUP_GUIDE.md for details
 """
 
 import os
+import re
 import sys
 import json
+import hashlib
 import logging
+import orjson
 import requests
+import time
 import uuid
+import threading
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from flask import Flask, send_from_directory, request, jsonify, Response
+from flask.json.provider import JSONProvider
 
 # Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stdout)
@@ -26,7 +36,35 @@ logger = logging.getLogger(__name__)
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 DIST_DIR = os.path.join(APP_DIR, 'dist')
 
-app = Flask(__name__, static_folder=DIST_DIR, static_url_path='')
+# Built frontend files (relative, '/'-separated) - fixed for the life of the process
+DIST_FILES = frozenset(
+    os.path.relpath(os.path.join(root, name), DIST_DIR).replace(os.sep, '/')
+    for root, _, names in os.walk(DIST_DIR)
+    for name in names
+)
+
+# Vite fingerprints every file it emits under assets/, so their URLs change whenever the content does
+HASHED_ASSETS_PREFIX = 'assets/'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson - used by jsonify() and request.get_json()"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of round-tripping through str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=str), mimetype="application/json")
+
+
+# Static files are served by serve_static() so unknown paths fall back to the SPA
+app = Flask(__name__, static_folder=None)
+app.json = OrjsonProvider(app)
 
 # ============================================================
 # CONFIGURATION - Read from environment variables (set in app.yaml)
@@ -35,6 +73,18 @@ DATABRICKS_HOST = os.getenv("DATABRICKS_HOST")
 SERVING_ENDPOINT = os.getenv("SERVING_ENDPOINT")
 LAKEBASE_INSTANCE_NAME = os.getenv("LAKEBASE_INSTANCE_NAME")
 LAKEBASE_DB = "databricks_postgres"  # Default Lakebase database name
+LAKEBASE_POOL_MIN = 2   # Connections opened when the pool is built
+LAKEBASE_POOL_MAX = 10  # Request threads + background writers (see gunicorn.conf.py); also how many are kept idle
+LAKEBASE_CREDENTIAL_TTL = 1800  # Seconds before a Lakebase credential is regenerated
+LAKEBASE_CREDENTIAL_REFRESH_BUFFER = 60  # Refresh this many seconds early, while the old token still works
+LAKEBASE_IDLE_CHECK_AFTER = 30  # Seconds idle before a pooled connection is pinged on checkout
+LAKEBASE_TABLES_RETRY_INTERVAL = 60  # Seconds between attempts to create the memory tables after a failure
+MEMORY_CONTEXT_TTL = 60  # Seconds a user's formatted memory context is reused (dropped early on any write)
+MIN_EXTRACT_CHARS = 20  # Shorter replies cannot carry a customer fact worth storing
+MAX_TRACKED_THREADS = 1000  # Threads remembered for duplicate-response detection
+MAX_CACHED_KEYS = 1000  # Threads / users kept in each in-memory fallback cache (LRU)
+MAX_CACHED_ITEMS = 200  # Messages per thread / summaries per user kept in the fallback cache
+MAX_PENDING_WRITES = 100  # Queued background persistence jobs before new ones are dropped
 
 # Validate required config
 if not DATABRICKS_HOST:
@@ -49,108 +99,306 @@ logger.info(f"Workspace: {DATABRICKS_HOST}")
 logger.info(f"Agent endpoint: {SERVING_ENDPOINT}")
 logger.info(f"Lakebase instance: {LAKEBASE_INSTANCE_NAME}")
 
-# In-memory fallback if Lakebase connection fails
+# In-memory fallback, written only when Lakebase is unavailable (bounded, least recently used evicted first)
 MEMORY_CACHE = {
-    "conversations": {},  # thread_id -> list of messages
-    "user_memories": {},  # user_id -> list of memory items
-    "summaries": {}       # user_id -> list of conversation summaries
+    "conversations": OrderedDict(),  # thread_id -> deque of the last MAX_CACHED_ITEMS messages
+    "user_memories": OrderedDict(),  # user_id -> {(memory_type, memory_key): memory item}
+    "summaries": OrderedDict()       # user_id -> deque of the last MAX_CACHED_ITEMS conversation summaries
 }
+_memory_cache_lock = threading.Lock()
+
+# Precompiled extraction patterns
+_CUSTOMER_ID_PATTERN = r'customer\s*(?:id)?[:\s]*(\d{4,})'
+_EMAIL_RE = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+
+# Customer names (patterns like "Name: John Smith" or "Customer name is John Smith")
+_NAME_PATTERNS = [
+    ("full_name", r'(?:name|customer\s*name)[:\s]+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)+)'),  # Name: John Smith
+    ("first_name", r'(?:first\s*name)[:\s]+([A-Z][a-z]+)'),  # First name: John
+    ("last_name", r'(?:last\s*name)[:\s]+([A-Z][a-z]+)'),    # Last name: Smith
+]
+
+# Financial data (income, balance, credit score, etc.) - group name is the memory data type
+_FINANCIAL_PATTERNS = [
+    ("income", r'(?:income|annual\s*income)[:\s]*\$?([\d,]+(?:\.\d{2})?)'),
+    ("credit_score", r'(?:credit\s*score|fico)[:\s]*(\d{3})'),
+    ("balance", r'(?:balance|account\s*balance)[:\s]*\$?([\d,]+(?:\.\d{2})?)'),
+    ("total_assets", r'(?:total\s*assets)[:\s]*\$?([\d,]+(?:\.\d{2})?)'),
+    ("age", r'(?:age)[:\s]*(\d{1,3})(?:\s*years)?'),
+]
+
+# All of the above in one alternation, scanned once per response. Each family sits in a
+# lookahead so families can overlap, like separate findall() calls; the leading class
+# (first letters of every keyword) skips positions no pattern can start at. Emails are
+# scanned separately: an address such as customer12345@bank.com starts where a customer ID does.
+_SCAN_RE = re.compile(
+    "(?=[abcfilnt])(?=(?:" + "|".join(f"(?P<{name}>{pattern})" for name, pattern in
+                        [("customer_id", _CUSTOMER_ID_PATTERN)] + _NAME_PATTERNS + _FINANCIAL_PATTERNS) + "))",
+    re.IGNORECASE
+)
+
+# Risk phrases in precedence order: high, then low, then medium
+_RISK_MARKERS = (
+    ("high risk", "HIGH_RISK"),
+    ("high credit risk", "HIGH_RISK"),
+    ("low risk", "LOW_RISK"),
+    ("low credit risk", "LOW_RISK"),
+    ("medium risk", "MEDIUM_RISK"),
+    ("moderate risk", "MEDIUM_RISK"),
+)
+
+# Memory types included in the agent's memory context, with their context-line suffix
+_CONTEXT_FIELDS = {"customer_emails": "email", "risk_assessments": "risk"}
+
+# Digest of the last response mined for memories: thread_id -> blake2b digest
+_last_extracted = OrderedDict()
+
+# Formatted memory context per user: user_id -> (monotonic time, context string)
+_memory_context_cache = OrderedDict()
+
+# Bumped whenever a user's memory context is invalidated: user_id -> generation. A user missing
+# from the dict is at _context_generation_floor, the newest generation evicted from it.
+_context_generations = OrderedDict()
+_context_generation_floor = 0
+_context_generation_counter = 0
+
+# Guards updates and evictions of the per-process dicts above (least recently written evicted first)
+_tracking_lock = threading.Lock()
 
 # Cache for Lakebase connection info
 _lakebase_cache = {
     "instance": None,
     "credential": None,
     "credential_time": None,
-    "sp_identity": None
+    "sp_identity": None,
+    "pool": None,
+    "pool_token": None,
+    "workspace_client": None
 }
 
+_credential_lock = threading.Lock()
 
-def get_lakebase_connection():
-    """Get Lakebase PostgreSQL connection using Databricks SDK"""
-    try:
-        import psycopg2
-        from databricks.sdk import WorkspaceClient
-        
-        logger.info("🔄 Attempting Lakebase connection...")
+# Set once ensure_tables() has succeeded - the DDL runs on the first connection only
+_tables_ready = False
+_tables_retry_at = 0  # Monotonic time before which a failed ensure_tables() is not retried
+_tables_lock = threading.Lock()
+_workspace_client_lock = threading.Lock()
+
+# Memory writes happen after the response is returned to the browser
+_bg_executor = ThreadPoolExecutor(max_workers=4)
+_bg_slots = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+
+# Hot statements, PREPAREd server-side once per pooled connection
+PREPARED_STATEMENTS = {
+    "get_history": """
+        SELECT role, content FROM (
+            SELECT role, content, created_at FROM app_conversation_history
+            WHERE thread_id = $1 ORDER BY created_at DESC LIMIT $2
+        ) recent ORDER BY created_at
+    """,
+    "get_memory_context": """
+        SELECT c.memory_key, m.memory_type, m.memory_value
+        FROM (
+            SELECT memory_key, updated_at FROM app_user_memories
+            WHERE user_id = $1 AND memory_type = 'analyzed_customers'
+            ORDER BY updated_at DESC LIMIT 5
+        ) c
+        JOIN app_user_memories m ON m.user_id = $1 AND m.memory_key = c.memory_key
+            AND m.memory_type IN ('customer_emails', 'risk_assessments')
+        ORDER BY c.updated_at DESC, m.memory_type
+    """,
+    "store_summary": """
+        INSERT INTO app_conversation_summaries (user_id, thread_id, summary, customer_ids)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (thread_id) DO UPDATE SET summary = EXCLUDED.summary, customer_ids = EXCLUDED.customer_ids
+    """,
+}
+# Statement names already prepared on each connection
+_prepared_conns = weakref.WeakKeyDictionary()
+
+# Pool that handed out each checked-out connection (id(conn) -> pool)
+_pool_owners = {}
+# When each pooled connection was last handed back (conn -> monotonic time)
+_conn_idle_since = weakref.WeakKeyDictionary()
+_pool_lock = threading.Lock()
+
+
+def _credential_expired(ttl=LAKEBASE_CREDENTIAL_TTL - LAKEBASE_CREDENTIAL_REFRESH_BUFFER):
+    """True if there is no cached Lakebase credential or it is older than ttl seconds"""
+    issued = _lakebase_cache["credential_time"]
+    return (_lakebase_cache["credential"] is None or
+            issued is None or
+            time.monotonic() - issued > ttl)
+
+
+def _get_lakebase_pool(instance, sp_identity, cred):
+    """Return the connection pool for the current credential, rebuilding it after a refresh"""
+    from psycopg2.pool import ThreadedConnectionPool
+
+    with _pool_lock:
+        if _lakebase_cache["pool"] is None or _lakebase_cache["pool_token"] != cred.token:
+            logger.info(f"Creating Lakebase connection pool: host={instance.read_write_dns}, user={sp_identity}")
+            # Connections checked out of the previous pool stay valid and are closed on release
+            _lakebase_cache["pool"] = ThreadedConnectionPool(
+                LAKEBASE_POOL_MIN,
+                LAKEBASE_POOL_MAX,
+                host=instance.read_write_dns,
+                dbname=LAKEBASE_DB,
+                user=sp_identity,
+                password=cred.token,
+                sslmode="require",
+                connect_timeout=10
+            )
+            # psycopg2 closes returned connections beyond minconn - keep every one idle instead,
+            # so a burst of requests reuses them rather than reconnecting (TLS + auth) each time
+            _lakebase_cache["pool"].minconn = LAKEBASE_POOL_MAX
+            _lakebase_cache["pool_token"] = cred.token
+        return _lakebase_cache["pool"]
+
+
+def _get_workspace_client():
+    """Shared WorkspaceClient - config discovery and HTTP client setup happen once"""
+    if _lakebase_cache["workspace_client"] is None:
+        with _workspace_client_lock:
+            if _lakebase_cache["workspace_client"] is None:
+                from databricks.sdk import WorkspaceClient
+                w = WorkspaceClient()
+                logger.info(f"SDK initialized, host: {w.config.host}, auth_type: {w.config.auth_type}")
+                _lakebase_cache["workspace_client"] = w
+    return _lakebase_cache["workspace_client"]
+
+
+def _refresh_lakebase_info():
+    """Resolve identity and instance (once) and a fresh credential via the Databricks SDK"""
+    logger.info("🔄 Attempting Lakebase connection...")
+    
+    # Shared SDK client (uses app's service principal credentials)
+    w = _get_workspace_client()
+    
+    # Get the identity for connection
+    # For service principals, try multiple approaches
+    if _lakebase_cache.get("sp_identity") is None:
+        identity = None
         
-        # Initialize SDK (uses app's service principal credentials)
-        w = WorkspaceClient()
-        logger.info(f"SDK initialized, host: {w.config.host}, auth_type: {w.config.auth_type}")
+        # Approach 1: Try current_user.me()
+        # For service principals, use user_name (client ID) as that's what's registered in Lakebase
+        try:
+            me = w.current_user.me()
+            logger.info(f"current_user.me() result: user_name={me.user_name}, display_name={me.display_name}")
+            # Use user_name (client ID) - this is what's registered as the role in Lakebase
+            identity = me.user_name
+            if identity:
+                logger.info(f"Using identity (user_name/client_id): {identity}")
+        except Exception as e:
+            logger.warning(f"current_user.me() failed: {e}")
         
-        # Get the identity for connection
-        # For service principals, try multiple approaches
-        if _lakebase_cache.get("sp_identity") is None:
-            identity = None
-            
-            # Approach 1: Try current_user.me()
-            # For service principals, use user_name (client ID) as that's what's registered in Lakebase
+        # Approach 2: For service principals, try the application_id from config
+        if not identity:
             try:
-                me = w.current_user.me()
-                logger.info(f"current_user.me() result: user_name={me.user_name}, display_name={me.display_name}")
-                # Use user_name (client ID) - this is what's registered as the role in Lakebase
-                identity = me.user_name
-                if identity:
-                    logger.info(f"Using identity (user_name/client_id): {identity}")
+                # Service principals have client_id in config
+                client_id = getattr(w.config, 'client_id', None)
+                if client_id:
+                    identity = client_id
+                    logger.info(f"Using client_id: {identity}")
             except Exception as e:
-                logger.warning(f"current_user.me() failed: {e}")
-            
-            # Approach 2: For service principals, try the application_id from config
-            if not identity:
-                try:
-                    # Service principals have client_id in config
-                    client_id = getattr(w.config, 'client_id', None)
-                    if client_id:
-                        identity = client_id
-                        logger.info(f"Using client_id: {identity}")
-                except Exception as e:
-                    logger.warning(f"Could not get client_id: {e}")
-            
-            # Approach 3: Hardcoded fallback for this specific app
-            if not identity:
-                identity = "39aa4b23-5c12-45bc-ab0a-8d0b855adfe9"  # App's service principal client ID
-                logger.info(f"Using hardcoded client_id fallback: {identity}")
-            
-            _lakebase_cache["sp_identity"] = identity
+                logger.warning(f"Could not get client_id: {e}")
         
-        sp_identity = _lakebase_cache["sp_identity"]
-        logger.info(f"Final identity for Lakebase: {sp_identity}")
-        
-        # Get instance info (cache it)
-        if _lakebase_cache["instance"] is None:
-            logger.info(f"Getting Lakebase instance: {LAKEBASE_INSTANCE_NAME}")
-            _lakebase_cache["instance"] = w.database.get_database_instance(name=LAKEBASE_INSTANCE_NAME)
-            logger.info(f"Got instance, DNS: {_lakebase_cache['instance'].read_write_dns}")
+        # Approach 3: Hardcoded fallback for this specific app
+        if not identity:
+            identity = "39aa4b23-5c12-45bc-ab0a-8d0b855adfe9"  # App's service principal client ID
+            logger.info(f"Using hardcoded client_id fallback: {identity}")
         
-        instance = _lakebase_cache["instance"]
+        _lakebase_cache["sp_identity"] = identity
+    
+    logger.info(f"Final identity for Lakebase: {_lakebase_cache['sp_identity']}")
+    
+    # Get instance info (cache it)
+    if _lakebase_cache["instance"] is None:
+        logger.info(f"Getting Lakebase instance: {LAKEBASE_INSTANCE_NAME}")
+        _lakebase_cache["instance"] = w.database.get_database_instance(name=LAKEBASE_INSTANCE_NAME)
+        logger.info(f"Got instance, DNS: {_lakebase_cache['instance'].read_write_dns}")
+    
+    # Generate credential (refresh shortly before LAKEBASE_CREDENTIAL_TTL)
+    # Double-checked under a lock so concurrent requests share one refresh;
+    # while the old token is still within its TTL, other threads keep using it instead of waiting
+    if _credential_expired():
+        still_valid = not _credential_expired(LAKEBASE_CREDENTIAL_TTL)
+        if _credential_lock.acquire(blocking=not still_valid):
+            try:
+                if _credential_expired():
+                    logger.info("Generating new Lakebase credential...")
+                    _lakebase_cache["credential"] = w.database.generate_database_credential(
+                        request_id=str(uuid.uuid4()),
+                        instance_names=[LAKEBASE_INSTANCE_NAME]
+                    )
+                    _lakebase_cache["credential_time"] = time.monotonic()
+                    logger.info(f"Credential generated, token length: {len(_lakebase_cache['credential'].token)}")
+            finally:
+                _credential_lock.release()
+
+
+def _checkout(pool):
+    """pool.getconn(), replacing idle connections the server has dropped
+
+    Connections idle for LAKEBASE_IDLE_CHECK_AFTER seconds are pinged first; a dead one is
+    closed and the next is tried, so a server restart drains them all and opens a fresh one.
+    """
+    import psycopg2
+    for _ in range(LAKEBASE_POOL_MAX):
+        conn = pool.getconn()
+        idle_since = _conn_idle_since.pop(conn, None)
+        if idle_since is None or time.monotonic() - idle_since < LAKEBASE_IDLE_CHECK_AFTER:
+            return conn
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            logger.warning(f"⚠️ Dropping dead pooled Lakebase connection: {e}")
+            pool.putconn(conn, close=True)
+    return pool.getconn()
+
+
+def get_lakebase_connection():
+    """Check out a pooled Lakebase PostgreSQL connection using Databricks SDK credentials.
+
+    Callers must hand the connection back with release_lakebase_connection();
+    prefer the lakebase_connection() context manager.
+    """
+    try:
+        import psycopg2
         
-        # Generate credential (refresh if older than 30 minutes)
-        now = datetime.now()
-        if (_lakebase_cache["credential"] is None or 
-            _lakebase_cache["credential_time"] is None or
-            (now - _lakebase_cache["credential_time"]).seconds > 1800):
-            
-            logger.info("Generating new Lakebase credential...")
-            _lakebase_cache["credential"] = w.database.generate_database_credential(
-                request_id=str(uuid.uuid4()),
-                instance_names=[LAKEBASE_INSTANCE_NAME]
-            )
-            _lakebase_cache["credential_time"] = now
-            logger.info(f"Credential generated, token length: {len(_lakebase_cache['credential'].token)}")
+        # Warm path: identity, instance and a valid credential are cached - no SDK calls
+        if (_lakebase_cache["sp_identity"] is None or
+                _lakebase_cache["instance"] is None or
+                _credential_expired()):
+            _refresh_lakebase_info()
         
+        instance = _lakebase_cache["instance"]
+        sp_identity = _lakebase_cache["sp_identity"]
         cred = _lakebase_cache["credential"]
         
-        # Connect using psycopg2
-        logger.info(f"Connecting to Lakebase: host={instance.read_write_dns}, user={sp_identity}")
-        conn = psycopg2.connect(
-            host=instance.read_write_dns,
-            dbname=LAKEBASE_DB,
-            user=sp_identity,
-            password=cred.token,
-            sslmode="require",
-            connect_timeout=10
-        )
+        # Check out a connection from the pool (opened once, reused across requests)
+        pool = _get_lakebase_pool(instance, sp_identity, cred)
+        conn = _checkout(pool)
+        _pool_owners[id(conn)] = pool
+        
+        # Create tables once per process instead of on every request
+        global _tables_ready, _tables_retry_at
+        try:
+            if not _tables_ready and time.monotonic() >= _tables_retry_at:
+                with _tables_lock:
+                    if not _tables_ready and time.monotonic() >= _tables_retry_at:
+                        _tables_ready = ensure_tables(conn)
+                        if _tables_ready:
+                            _bg_executor.submit(ensure_indexes)
+                        else:
+                            _tables_retry_at = time.monotonic() + LAKEBASE_TABLES_RETRY_INTERVAL
+        except Exception:
+            release_lakebase_connection(conn)  # Don't leak the pool slot
+            raise
         
-        logger.info("✅ Lakebase connected successfully!")
+        logger.info("✅ Lakebase connection acquired from pool")
         return conn
         
     except ImportError as e:
@@ -163,10 +411,55 @@ def get_lakebase_connection():
         return None
 
 
-def ensure_tables(conn):
-    """Create memory tables if they don't exist"""
+def release_lakebase_connection(conn):
+    """Return a connection to the pool it came from"""
     if not conn:
         return
+    pool = _pool_owners.pop(id(conn), None)
+    if pool is None:
+        return  # Already released
+    try:
+        # Connections from a pool retired by a credential refresh are closed, not reused
+        _conn_idle_since[conn] = time.monotonic()
+        pool.putconn(conn, close=pool is not _lakebase_cache["pool"])
+    except Exception as e:
+        logger.warning(f"Error releasing Lakebase connection: {e}")
+
+
+@contextmanager
+def lakebase_connection():
+    """Pooled Lakebase connection for a with-block (None when Lakebase is unavailable)"""
+    conn = get_lakebase_connection()
+    try:
+        yield conn
+    finally:
+        release_lakebase_connection(conn)
+
+
+@contextmanager
+def lakebase_savepoint(conn, name):
+    """Run a with-block's writes under a savepoint, so a failed store rolls back only its own write
+
+    A transaction that has already failed is rolled back first - its failed store went to the fallback cache.
+    """
+    if not conn:
+        yield
+        return
+    from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+    if conn.info.transaction_status == TRANSACTION_STATUS_INERROR:
+        conn.rollback()
+    with conn.cursor() as cur:
+        cur.execute(f"SAVEPOINT {name}")
+    yield
+    if conn.info.transaction_status == TRANSACTION_STATUS_INERROR:
+        with conn.cursor() as cur:
+            cur.execute(f"ROLLBACK TO SAVEPOINT {name}")
+
+
+def ensure_tables(conn):
+    """Create memory tables if they don't exist; True on success (indexes: see ensure_indexes())"""
+    if not conn:
+        return False
     try:
         with conn.cursor() as cur:
             # Conversation history table
@@ -208,30 +501,96 @@ def ensure_tables(conn):
             logger.info("Memory tables ensured")
     except Exception as e:
         logger.error(f"Error creating tables: {e}")
+        conn.rollback()
+        return False
+    return True
+
 
+def ensure_indexes():
+    """Create the memory table indexes in the background (submitted once the tables exist)
 
-def store_message(conn, thread_id, user_id, role, content):
-    """Store a message in conversation history"""
+    Built CONCURRENTLY so writes to an existing large table are not blocked meanwhile. Best-effort:
+    it fails when the tables belong to another role (e.g. created by setup/06_create_lakebase.py).
+    """
+    with lakebase_connection() as conn:
+        if not conn:
+            return
+        try:
+            conn.rollback()  # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                # Indexes matching the per-thread / per-user "most recent first" reads
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_hist_thread_created ON app_conversation_history (thread_id, created_at DESC)")
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_hist_user_created ON app_conversation_history (user_id, created_at DESC)")
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_mem_user_updated ON app_user_memories (user_id, updated_at DESC)")
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sum_user_created ON app_conversation_summaries (user_id, created_at DESC)")
+            logger.info("Memory table indexes ensured")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not create memory table indexes: {e}")
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
+
+
+def _execute_prepared(cur, name, params):
+    """Run one of PREPARED_STATEMENTS, preparing it on its first use on the connection"""
+    prepared = _prepared_conns.setdefault(cur.connection, set())
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_STATEMENTS[name]}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+
+def _cache_entry(name, key, factory):
+    """MEMORY_CACHE[name][key], created with factory() if missing; evicts the least recently used key"""
+    cache = MEMORY_CACHE[name]
+    with _memory_cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            entry = cache[key] = factory()
+            if len(cache) > MAX_CACHED_KEYS:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return entry
+
+
+def store_messages(conn, thread_id, user_id, messages, commit=True):
+    """Store (role, content) messages in conversation history in a single round-trip
+
+    commit=False leaves the transaction open for the caller to commit.
+    Returns True if Lakebase took the write, False if it went to the fallback cache.
+    """
+    if not messages:
+        return False
+    
+    stored = False
     if conn:
         try:
+            from psycopg2.extras import execute_values
             with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO app_conversation_history (thread_id, user_id, role, content) VALUES (%s, %s, %s, %s)",
-                    (thread_id, user_id, role, content)
-                )
-                conn.commit()
-                logger.info(f"Stored message in Lakebase: {role} ({len(content)} chars)")
+                # clock_timestamp() keeps a batch in order; CURRENT_TIMESTAMP is fixed per transaction
+                execute_values(cur,
+                    "INSERT INTO app_conversation_history (thread_id, user_id, role, content, created_at) VALUES %s",
+                    [(thread_id, user_id, role, content) for role, content in messages],
+                    template="(%s, %s, %s, %s, clock_timestamp())")
+                if commit:
+                    conn.commit()
+                logger.info(f"Stored {len(messages)} messages in Lakebase")
+                stored = True
         except Exception as e:
-            logger.error(f"Error storing message: {e}")
-    
-    # Also store in cache
-    if thread_id not in MEMORY_CACHE["conversations"]:
-        MEMORY_CACHE["conversations"][thread_id] = []
-    MEMORY_CACHE["conversations"][thread_id].append({
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat()
-    })
+            logger.error(f"Error storing messages: {e}")
+    
+    # Fallback cache - only written when Lakebase did not take the write
+    if not stored:
+        conversation = _cache_entry("conversations", thread_id, lambda: deque(maxlen=MAX_CACHED_ITEMS))
+        for role, content in messages:
+            conversation.append({
+                "role": role,
+                "content": content,
+                "timestamp": datetime.now().isoformat()
+            })
+    return stored
 
 
 def get_conversation_history(conn, thread_id, limit=20):
@@ -241,257 +600,280 @@ def get_conversation_history(conn, thread_id, limit=20):
     if conn:
         try:
             with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT role, content FROM app_conversation_history WHERE thread_id = %s ORDER BY created_at DESC LIMIT %s",
-                    (thread_id, limit)
-                )
-                rows = cur.fetchall()
-                messages = [{"role": row[0], "content": row[1]} for row in reversed(rows)]
+                _execute_prepared(cur, "get_history", (thread_id, limit))
+                messages = [{"role": role, "content": content} for role, content in cur.fetchall()]
                 logger.info(f"Retrieved {len(messages)} messages from Lakebase")
         except Exception as e:
             logger.error(f"Error getting history: {e}")
     
     # Fallback to cache
     if not messages and thread_id in MEMORY_CACHE["conversations"]:
-        messages = [{"role": m["role"], "content": m["content"]} for m in MEMORY_CACHE["conversations"][thread_id][-limit:]]
+        cached = list(MEMORY_CACHE["conversations"].get(thread_id, ()))
+        messages = [{"role": m["role"], "content": m["content"]} for m in cached[-limit:]]
     
     return messages
 
 
-def store_user_memory(conn, user_id, memory_type, memory_key, memory_value):
-    """Store a long-term memory for a user"""
+def store_user_memories(conn, user_id, items, commit=True):
+    """Store several long-term memories for a user in a single round-trip
+
+    items: iterable of (memory_type, memory_key, memory_value); the last value wins for a repeated key
+    commit=False leaves the transaction open for the caller to commit
+    """
+    # One row per key - ON CONFLICT cannot update the same row twice in one statement
+    latest = {(memory_type, memory_key): memory_value for memory_type, memory_key, memory_value in items}
+    if not latest:
+        return
+    
+    stored = False
     if conn:
         try:
+            from psycopg2.extras import execute_values
             with conn.cursor() as cur:
-                cur.execute("""
+                # Rows whose value is unchanged are left alone; analyzed_customers rows are always
+                # updated so their updated_at keeps tracking the latest analysis
+                execute_values(cur, """
                     INSERT INTO app_user_memories (user_id, memory_type, memory_key, memory_value, updated_at)
-                    VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP)
+                    VALUES %s
                     ON CONFLICT (user_id, memory_type, memory_key) 
                     DO UPDATE SET memory_value = EXCLUDED.memory_value, updated_at = CURRENT_TIMESTAMP
-                """, (user_id, memory_type, memory_key, memory_value))
-                conn.commit()
-                logger.info(f"Stored memory: {memory_type}/{memory_key}")
+                    WHERE app_user_memories.memory_value IS DISTINCT FROM EXCLUDED.memory_value
+                        OR app_user_memories.memory_type = 'analyzed_customers'
+                """, [(user_id, t, k, v) for (t, k), v in sorted(latest.items())],  # Fixed row order avoids lock-order deadlocks
+                    template="(%s, %s, %s, %s, CURRENT_TIMESTAMP)", page_size=100)
+                if commit:
+                    conn.commit()
+                logger.info(f"Stored {len(latest)} memories in one batch")
+                stored = True
         except Exception as e:
-            logger.error(f"Error storing memory: {e}")
-    
-    # Also store in cache
-    if user_id not in MEMORY_CACHE["user_memories"]:
-        MEMORY_CACHE["user_memories"][user_id] = []
-    
-    # Update or add
-    found = False
-    for mem in MEMORY_CACHE["user_memories"][user_id]:
-        if mem["memory_type"] == memory_type and mem["memory_key"] == memory_key:
-            mem["memory_value"] = memory_value
-            found = True
-            break
-    if not found:
-        MEMORY_CACHE["user_memories"][user_id].append({
-            "memory_type": memory_type,
-            "memory_key": memory_key,
-            "memory_value": memory_value
-        })
+            logger.error(f"Error storing memories: {e}")
+    
+    # Fallback cache - only written when Lakebase did not take the write
+    if not stored:
+        for (memory_type, memory_key), memory_value in latest.items():
+            _cache_user_memory(user_id, memory_type, memory_key, memory_value)
+    # With commit=False the caller drops the cached context once its transaction commits
+    if commit or not stored:
+        _invalidate_memory_context(user_id)
 
 
-def get_user_memories(conn, user_id, limit=20):
-    """Get long-term memories for a user"""
-    memories = []
-    
-    if conn:
-        try:
-            with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT memory_type, memory_key, memory_value, updated_at FROM app_user_memories WHERE user_id = %s ORDER BY updated_at DESC LIMIT %s",
-                    (user_id, limit)
-                )
-                memories = [
-                    {"memory_type": row[0], "memory_key": row[1], "memory_value": row[2], "updated_at": str(row[3])}
-                    for row in cur.fetchall()
-                ]
-                logger.info(f"Retrieved {len(memories)} memories from Lakebase")
-        except Exception as e:
-            logger.error(f"Error getting memories: {e}")
-    
-    # Fallback to cache
-    if not memories and user_id in MEMORY_CACHE["user_memories"]:
-        memories = MEMORY_CACHE["user_memories"][user_id][:limit]
-    
-    return memories
+def _cache_user_memory(user_id, memory_type, memory_key, memory_value):
+    """Mirror a memory into the in-memory fallback cache"""
+    # Update or add - keyed by (type, key), so no scan over the user's memories
+    _cache_entry("user_memories", user_id, dict)[(memory_type, memory_key)] = {
+        "memory_type": memory_type,
+        "memory_key": memory_key,
+        "memory_value": memory_value
+    }
 
 
-def store_conversation_summary(conn, user_id, thread_id, summary, customer_ids=None):
-    """Store a conversation summary"""
+def _cached_user_memories(user_id, limit=20):
+    """A user's memories from the in-memory fallback cache"""
+    return list(MEMORY_CACHE["user_memories"].get(user_id, {}).values())[:limit]
+
+
+def store_conversation_summary(conn, user_id, thread_id, summary, customer_ids=None, commit=True):
+    """Store a conversation summary (commit=False leaves the transaction open)"""
     customer_ids_str = ",".join(customer_ids) if customer_ids else ""
     
+    stored = False
     if conn:
         try:
             with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO app_conversation_summaries (user_id, thread_id, summary, customer_ids)
-                    VALUES (%s, %s, %s, %s)
-                    ON CONFLICT (thread_id) DO UPDATE SET summary = EXCLUDED.summary, customer_ids = EXCLUDED.customer_ids
-                """, (user_id, thread_id, summary, customer_ids_str))
-                conn.commit()
+                _execute_prepared(cur, "store_summary", (user_id, thread_id, summary, customer_ids_str))
+                if commit:
+                    conn.commit()
                 logger.info(f"Stored conversation summary")
+                stored = True
         except Exception as e:
             logger.error(f"Error storing summary: {e}")
     
-    # Also store in cache
-    if user_id not in MEMORY_CACHE["summaries"]:
-        MEMORY_CACHE["summaries"][user_id] = []
-    MEMORY_CACHE["summaries"][user_id].append({
-        "thread_id": thread_id,
-        "summary": summary,
-        "customer_ids": customer_ids or []
-    })
+    # Fallback cache - only written when Lakebase did not take the write
+    if not stored:
+        _cache_entry("summaries", user_id, lambda: deque(maxlen=MAX_CACHED_ITEMS)).append({
+            "thread_id": thread_id,
+            "summary": summary,
+            "customer_ids": customer_ids or []
+        })
+
+
+def _cached_conversation_summaries(user_id, limit=5):
+    """A user's conversation summaries from the in-memory fallback cache"""
+    return list(MEMORY_CACHE["summaries"].get(user_id, ()))[:limit]
 
 
-def get_conversation_summaries(conn, user_id, limit=5):
-    """Get recent conversation summaries for a user"""
-    summaries = []
+def get_memory_snapshot(conn, user_id, memory_limit=20, summary_limit=5):
+    """Get a user's memories and conversation summaries in one round-trip
+
+    Falls back to the in-memory cache for whichever of the two Lakebase did not return.
+    """
+    memories, summaries = [], []
     
     if conn:
         try:
             with conn.cursor() as cur:
-                cur.execute(
-                    "SELECT thread_id, summary, customer_ids, created_at FROM app_conversation_summaries WHERE user_id = %s ORDER BY created_at DESC LIMIT %s",
-                    (user_id, limit)
-                )
-                summaries = [
-                    {
-                        "thread_id": row[0],
-                        "summary": row[1],
-                        "customer_ids": row[2].split(",") if row[2] else [],
-                        "created_at": str(row[3])
-                    }
-                    for row in cur.fetchall()
-                ]
+                cur.execute("""
+                    SELECT
+                        (SELECT COALESCE(json_agg(m), '[]') FROM (
+                            SELECT memory_type, memory_key, memory_value, updated_at::text AS updated_at
+                            FROM app_user_memories WHERE user_id = %(user_id)s
+                            ORDER BY app_user_memories.updated_at DESC LIMIT %(memory_limit)s
+                        ) m),
+                        (SELECT COALESCE(json_agg(s), '[]') FROM (
+                            SELECT thread_id, summary, customer_ids, created_at::text AS created_at
+                            FROM app_conversation_summaries WHERE user_id = %(user_id)s
+                            ORDER BY app_conversation_summaries.created_at DESC LIMIT %(summary_limit)s
+                        ) s)
+                """, {"user_id": user_id, "memory_limit": memory_limit, "summary_limit": summary_limit})
+                memories, summaries = cur.fetchone()
+                for summary in summaries:
+                    summary["customer_ids"] = summary["customer_ids"].split(",") if summary["customer_ids"] else []
+                logger.info(f"Retrieved {len(memories)} memories and {len(summaries)} summaries from Lakebase")
         except Exception as e:
-            logger.error(f"Error getting summaries: {e}")
+            logger.error(f"Error getting memory snapshot: {e}")
     
     # Fallback to cache
-    if not summaries and user_id in MEMORY_CACHE["summaries"]:
-        summaries = MEMORY_CACHE["summaries"][user_id][:limit]
+    if not memories:
+        memories = _cached_user_memories(user_id, memory_limit)
+    if not summaries:
+        summaries = _cached_conversation_summaries(user_id, summary_limit)
     
-    return summaries
-
-
-def extract_customer_ids(text):
-    """Extract customer IDs from text"""
-    import re
-    matches = re.findall(r'customer\s*(?:id)?[:\s]*(\d{4,})', text.lower())
-    return list(set(matches))
+    return memories, summaries
 
 
 def extract_emails(text):
     """Extract email addresses from text"""
-    import re
-    # Match email addresses
-    email_pattern = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
-    matches = re.findall(email_pattern, text)
+    matches = _EMAIL_RE.findall(text)
     return list(set(matches))
 
 
-def extract_memories_from_response(response_text, user_id, conn):
-    """Extract and store key information from agent response"""
-    import re
+def _scan_response(text):
+    """Run _SCAN_RE once: group name -> captured values in text order (findall() semantics per group)"""
+    found = {}
+    ends = {}
+    for m in _SCAN_RE.finditer(text):
+        name = m.lastgroup
+        start, end = m.span(name)
+        if start < ends.get(name, 0):
+            continue  # Overlaps the previous match of the same pattern
+        ends[name] = end
+        found.setdefault(name, []).append(m.group(_SCAN_RE.groupindex[name] + 1))
+    return found
+
+
+def extract_memories_from_response(response_text, user_id, conn, commit=True):
+    """Extract and store key information from agent response.
+
+    Returns the customer IDs found so callers can reuse them.
+    """
+    rows = []  # (memory_type, memory_key, memory_value)
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    found = _scan_response(response_text)
     
     # Extract customer IDs mentioned
-    customer_ids = extract_customer_ids(response_text)
+    customer_ids = list(set(found.get("customer_id", [])))
     for cid in customer_ids:
-        store_user_memory(conn, user_id, "analyzed_customers", f"customer_{cid}", 
-                         f"Analyzed on {datetime.now().strftime('%Y-%m-%d')}")
-    
-    # Extract risk levels mentioned
-    if "high risk" in response_text.lower() or "high credit risk" in response_text.lower():
-        for cid in customer_ids:
-            store_user_memory(conn, user_id, "risk_assessments", f"customer_{cid}", "HIGH_RISK")
-    elif "low risk" in response_text.lower() or "low credit risk" in response_text.lower():
-        for cid in customer_ids:
-            store_user_memory(conn, user_id, "risk_assessments", f"customer_{cid}", "LOW_RISK")
-    elif "medium risk" in response_text.lower() or "moderate risk" in response_text.lower():
-        for cid in customer_ids:
-            store_user_memory(conn, user_id, "risk_assessments", f"customer_{cid}", "MEDIUM_RISK")
+        rows.append(("analyzed_customers", f"customer_{cid}", f"Analyzed on {today}"))
+    
+    # Extract risk levels mentioned (first matching marker wins)
+    if customer_ids:
+        lowered = response_text.lower()
+        risk = next((level for marker, level in _RISK_MARKERS if marker in lowered), None)
+        if risk:
+            for cid in customer_ids:
+                rows.append(("risk_assessments", f"customer_{cid}", risk))
     
     # Extract email addresses and associate with customer IDs
     emails = extract_emails(response_text)
     if emails and customer_ids:
         for email in emails:
             for cid in customer_ids:
-                store_user_memory(conn, user_id, "customer_emails", f"customer_{cid}", email)
-                logger.info(f"Stored email {email} for customer {cid}")
+                rows.append(("customer_emails", f"customer_{cid}", email))
     elif emails:
         for email in emails:
-            store_user_memory(conn, user_id, "discovered_emails", email, 
-                            f"Found on {datetime.now().strftime('%Y-%m-%d')}")
-    
-    # Extract customer names (patterns like "Name: John Smith" or "Customer name is John Smith")
-    name_patterns = [
-        r'(?:name|customer\s*name)[:\s]+([A-Z][a-z]+(?:\s+[A-Z][a-z]+)+)',  # Name: John Smith
-        r'(?:first\s*name)[:\s]+([A-Z][a-z]+)',  # First name: John
-        r'(?:last\s*name)[:\s]+([A-Z][a-z]+)',   # Last name: Smith
-    ]
-    for pattern in name_patterns:
-        matches = re.findall(pattern, response_text, re.IGNORECASE)
+            rows.append(("discovered_emails", email, f"Found on {today}"))
+    
+    # Extract customer names
+    for name_type, _ in _NAME_PATTERNS:
+        matches = found.get(name_type)
         if matches and customer_ids:
             for name in matches[:1]:  # Only first match
                 for cid in customer_ids:
-                    store_user_memory(conn, user_id, "customer_names", f"customer_{cid}", name)
-                    logger.info(f"Stored name {name} for customer {cid}")
+                    rows.append(("customer_names", f"customer_{cid}", name))
     
     # Extract financial data (income, balance, credit score, etc.)
-    financial_patterns = [
-        (r'(?:income|annual\s*income)[:\s]*\$?([\d,]+(?:\.\d{2})?)', "income"),
-        (r'(?:credit\s*score|fico)[:\s]*(\d{3})', "credit_score"),
-        (r'(?:balance|account\s*balance)[:\s]*\$?([\d,]+(?:\.\d{2})?)', "balance"),
-        (r'(?:total\s*assets)[:\s]*\$?([\d,]+(?:\.\d{2})?)', "total_assets"),
-        (r'(?:age)[:\s]*(\d{1,3})(?:\s*years)?', "age"),
-    ]
-    for pattern, data_type in financial_patterns:
-        matches = re.findall(pattern, response_text, re.IGNORECASE)
+    for data_type, _ in _FINANCIAL_PATTERNS:
+        matches = found.get(data_type)
         if matches and customer_ids:
             for value in matches[:1]:  # Only first match
                 for cid in customer_ids:
-                    store_user_memory(conn, user_id, f"customer_{data_type}", f"customer_{cid}", str(value))
-                    logger.info(f"Stored {data_type}={value} for customer {cid}")
+                    rows.append((f"customer_{data_type}", f"customer_{cid}", str(value)))
+    
+    # Write everything in one round-trip
+    store_user_memories(conn, user_id, rows, commit=commit)
+    
+    return customer_ids
 
 
 def build_memory_context(conn, user_id, thread_id):
     """Build CONCISE memory context - just key facts the agent can reference silently"""
     
-    # Get user memories
-    memories = get_user_memories(conn, user_id, limit=50)
-    if not memories:
-        return ""
+    # Served from cache until the TTL lapses or the user's memories change
+    cached = _memory_context_cache.get(user_id)
+    if cached and time.monotonic() - cached[0] < MEMORY_CONTEXT_TTL:
+        return cached[1]
     
-    # Group memories by customer
-    customer_data = {}
-    for m in memories:
-        if m["memory_key"].startswith("customer_"):
-            cid = m["memory_key"].replace("customer_", "")
-            if cid not in customer_data:
-                customer_data[cid] = {}
-            customer_data[cid][m["memory_type"]] = m["memory_value"]
+    with _tracking_lock:
+        generation = _context_generations.get(user_id, _context_generation_floor)
+    context = _build_memory_context(conn, user_id)
+    with _tracking_lock:
+        # Not cached if the memories changed while it was read - it may predate the write
+        if _context_generations.get(user_id, _context_generation_floor) == generation:
+            _memory_context_cache[user_id] = (time.monotonic(), context)
+            _memory_context_cache.move_to_end(user_id)  # Oldest entry is evicted first
+            if len(_memory_context_cache) > MAX_CACHED_KEYS:
+                _memory_context_cache.popitem(last=False)
+    return context
+
+
+def _invalidate_memory_context(user_id):
+    """Drop a user's cached memory context, and keep a rebuild already in progress from caching its result"""
+    global _context_generation_counter, _context_generation_floor
+    with _tracking_lock:
+        _memory_context_cache.pop(user_id, None)
+        _context_generation_counter += 1
+        _context_generations[user_id] = _context_generation_counter
+        _context_generations.move_to_end(user_id)
+        if len(_context_generations) > MAX_CACHED_KEYS:
+            # Least recently bumped first, so the floor only grows and an evicted user still reads as changed
+            _context_generation_floor = _context_generations.popitem(last=False)[1]
+
+
+def _build_memory_context(conn, user_id):
+    # Only the email and risk of the 5 most recently analyzed customers go into the context
+    rows = []  # (memory_key, memory_type, memory_value)
+    if conn:
+        try:
+            with conn.cursor() as cur:
+                _execute_prepared(cur, "get_memory_context", (user_id,))
+                rows = cur.fetchall()
+        except Exception as e:
+            logger.error(f"Error getting memory context: {e}")
     
-    if not customer_data:
-        return ""
+    # Fallback to cache
+    if not rows and user_id in MEMORY_CACHE["user_memories"]:
+        cached = dict(MEMORY_CACHE["user_memories"].get(user_id, {}))
+        recent = [key for memory_type, key in reversed(cached) if memory_type == "analyzed_customers"][:5]
+        rows = [(key, memory_type, cached[(memory_type, key)]["memory_value"])
+                for key in recent for memory_type in _CONTEXT_FIELDS if (memory_type, key) in cached]
     
     # Build MINIMAL context - just customer ID and key identifiers
-    context_lines = []
-    for cid, data in list(customer_data.items())[:5]:  # Only last 5 customers
-        # Only include email (most likely to be asked about)
-        if "customer_emails" in data:
-            context_lines.append(f"customer_{cid}_email={data['customer_emails']}")
-        if "risk_assessments" in data:
-            context_lines.append(f"customer_{cid}_risk={data['risk_assessments']}")
-    
-    if context_lines:
-        return "|".join(context_lines)
-    return ""
+    return "|".join(f"{key}_{_CONTEXT_FIELDS[memory_type]}={value}" for key, memory_type, value in rows)
 
 
-def extract_token(req):
-    """Extract token from various sources for agent calls"""
+def extract_token(req, payload=None):
+    """Extract token from various sources for agent calls (payload: the already-parsed JSON body)"""
     auth_header = req.headers.get('Authorization', '')
     if auth_header.startswith('Bearer '):
         return auth_header[7:]
@@ -500,19 +882,114 @@ def extract_token(req):
     if token:
         return token
     
-    if req.json and req.json.get('_auth_token'):
-        return req.json.get('_auth_token')
+    body = req.json if payload is None else payload
+    if body and body.get('_auth_token'):
+        return body.get('_auth_token')
+    
+    # Serving containers usually have the token in env - avoid SDK config discovery
+    token = os.getenv("DATABRICKS_TOKEN")
+    if token:
+        return token
     
     try:
-        from databricks.sdk import WorkspaceClient
-        w = WorkspaceClient()
-        return w.config.token
+        return _get_workspace_client().config.token
     except:
         pass
     
     return None
 
 
+def _first_extraction(thread_id, response_text):
+    """Record response_text as the last reply mined in thread_id; False if it repeats the previous one"""
+    digest = hashlib.blake2b(response_text.encode(), digest_size=16).digest()
+    with _tracking_lock:
+        if _last_extracted.get(thread_id) == digest:
+            return False
+        _last_extracted[thread_id] = digest
+        _last_extracted.move_to_end(thread_id)
+        if len(_last_extracted) > MAX_TRACKED_THREADS:
+            _last_extracted.popitem(last=False)
+    return True
+
+
+def _turn_messages(user_text, response_text):
+    """(role, content) history rows for one turn"""
+    messages = []
+    if user_text is not None:
+        messages.append(('user', user_text))
+    if response_text:
+        messages.append(('assistant', response_text[:2000]))
+    return messages
+
+
+def _persist_response(user_id, thread_id, user_text, response_text):
+    """Store the user turn, assistant reply, extracted memories and summary (runs on _bg_executor)
+
+    All writes share one transaction; the memory and summary writes each run under a savepoint
+    so the conversation history is committed even if they fail.
+    """
+    messages = _turn_messages(user_text, response_text)
+    with lakebase_connection() as conn:
+        in_lakebase = committed = False
+        try:
+            in_lakebase = store_messages(conn, thread_id, user_id, messages, commit=False)
+            
+            # Skip extraction for trivial replies or a repeat of the last one in this thread
+            if len(response_text) < MIN_EXTRACT_CHARS or not _first_extraction(thread_id, response_text):
+                logger.info("Response too short or unchanged - skipping memory extraction")
+            else:
+                # Extract and store memories - each under a savepoint, so a failure cannot roll back the history
+                with lakebase_savepoint(conn, "store_memories"):
+                    customer_ids = extract_memories_from_response(response_text, user_id, conn, commit=False)
+                
+                # Create conversation summary (simple version)
+                if customer_ids:
+                    summary = f"Analyzed customers: {', '.join(customer_ids[:3])}"
+                    with lakebase_savepoint(conn, "store_summary"):
+                        store_conversation_summary(conn, user_id, thread_id, summary, customer_ids, commit=False)
+            
+            if conn:
+                from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+                if conn.info.transaction_status == TRANSACTION_STATUS_INERROR:
+                    conn.rollback()  # Only the history insert failed, and it went to the fallback cache
+                else:
+                    conn.commit()
+                    committed = True
+                    _invalidate_memory_context(user_id)
+        except Exception as e:
+            logger.exception(f"Error persisting response: {e}")
+            if in_lakebase and not committed:
+                store_messages(None, thread_id, user_id, messages)  # Keep the turn in the fallback cache
+
+
+def _submit_persist(user_id, thread_id, user_text, response_text):
+    """Queue _persist_response on _bg_executor; when the backlog is full only the history is stored, inline"""
+    if not _bg_slots.acquire(blocking=False):
+        # Memory extraction is skipped, but the turn still reaches the history (or the fallback cache)
+        logger.warning(f"⚠️ Persistence backlog full ({MAX_PENDING_WRITES}) - storing history only for thread {thread_id}")
+        with lakebase_connection() as conn:
+            store_messages(conn, thread_id, user_id, _turn_messages(user_text, response_text))
+        return
+    future = _bg_executor.submit(_persist_response, user_id, thread_id, user_text, response_text)
+    future.add_done_callback(lambda _: _bg_slots.release())
+
+
+def _relay_agent_stream(resp, user_id, thread_id, user_text):
+    """Yield the agent's server-sent events as they arrive, then persist the turn from the streamed text"""
+    text_parts = []
+    try:
+        for line in resp.iter_lines(chunk_size=None):
+            if line.startswith(b'data:') and b'output_text.delta' in line:
+                try:
+                    text_parts.append(orjson.loads(line[5:]).get('delta') or '')
+                except orjson.JSONDecodeError:
+                    pass
+            yield line + b'\n'
+    finally:
+        resp.close()
+        _submit_persist(user_id, thread_id, user_text, "".join(text_parts))
+
+
 @app.route('/')
 def serve_index():
     return send_from_directory(DIST_DIR, 'index.html')
@@ -522,13 +999,17 @@ def serve_index():
 def proxy_endpoint(endpoint_path):
     """Proxy to agent with memory injection"""
     logger.info(f"=== Agent request with memory ===")
+    user_text = None
     
     try:
-        token = extract_token(request)
+        # Parse the body once - it is modified in place and re-encoded with orjson for the agent
+        raw_body = request.get_data(cache=False)
+        payload = orjson.loads(raw_body) if raw_body else {}
+        
+        token = extract_token(request, payload)
         if not token:
             return jsonify({"error": "Authentication required", "detail": "No token found"}), 401
         
-        payload = request.json.copy() if request.json else {}
         payload.pop('_auth_token', None)
         
         # Get user_id and thread_id from custom_inputs
@@ -538,28 +1019,28 @@ def proxy_endpoint(endpoint_path):
         
         logger.info(f"User: {user_id}, Thread: {thread_id}")
         
-        # Connect to Lakebase using SDK credentials (service principal)
-        conn = get_lakebase_connection()
-        if conn:
-            ensure_tables(conn)
-            logger.info("🧠 Lakebase memory ACTIVE")
-        else:
-            logger.info("⚠️ Using in-memory fallback")
-        
         # Get input messages
         input_messages = payload.get('input', [])
         
-        # Store the new user message
-        if input_messages:
-            last_user_msg = next((m for m in reversed(input_messages) if m.get('role') == 'user'), None)
-            if last_user_msg:
-                store_message(conn, thread_id, user_id, 'user', last_user_msg.get('content', ''))
-        
-        # Build memory context
-        memory_context = build_memory_context(conn, user_id, thread_id)
+        # Connect to Lakebase using SDK credentials (service principal);
+        # the connection goes back to the pool before the agent call
+        with lakebase_connection() as conn:
+            if conn:
+                logger.info("🧠 Lakebase memory ACTIVE")
+            else:
+                logger.info("⚠️ Using in-memory fallback")
+            memory_storage = "lakebase" if conn else "in_memory"
+            
+            # Build memory context
+            memory_context = build_memory_context(conn, user_id, thread_id)
+            
+            # Get conversation history from this thread
+            history = get_conversation_history(conn, thread_id, limit=10)
         
-        # Get conversation history from this thread
-        history = get_conversation_history(conn, thread_id, limit=10)
+        # The new user message is stored together with the reply once the agent answers
+        last_user_msg = next((m for m in reversed(input_messages) if m.get('role') == 'user'), None)
+        if last_user_msg:
+            user_text = last_user_msg.get('content', '')
         
         # Build enhanced input with memory
         enhanced_input = []
@@ -572,21 +1053,17 @@ def proxy_endpoint(endpoint_path):
             })
         
         # Add conversation history (for short-term memory within thread)
-        if history and len(history) > 1:
-            # Add previous messages as context
-            for msg in history[:-1]:  # Exclude the last one (current message)
-                enhanced_input.append(msg)
+        enhanced_input.extend(history)
         
         # Add the current user message(s)
-        for msg in input_messages:
-            enhanced_input.append(msg)
+        enhanced_input.extend(input_messages)
         
         # Update payload with enhanced input
         payload['input'] = enhanced_input
         
         logger.info(f"Sending {len(enhanced_input)} messages to agent (with memory context)")
         
-        # Call the agent
+        # Call the agent (streamed - the body is read only where it is needed)
         target_url = f"{DATABRICKS_HOST}/serving-endpoints/{endpoint_path}"
         resp = requests.post(
             target_url,
@@ -594,80 +1071,78 @@ def proxy_endpoint(endpoint_path):
                 'Content-Type': 'application/json',
                 'Authorization': f'Bearer {token}'
             },
-            json=payload,
+            data=orjson.dumps(payload),
+            stream=True,
             timeout=120
         )
         
         logger.info(f"Agent response: {resp.status_code}")
         
+        # Streaming requests: relay events as the agent produces them instead of after it finishes.
+        # Only external callers that send "stream": true take this path - the bundled React client
+        # (src/services/agentService.js) sends non-streaming requests, since its MCP approval loop
+        # needs the complete output of each call.
+        if resp.status_code == 200 and payload.get('stream'):
+            events = Response(_relay_agent_stream(resp, user_id, thread_id, user_text),
+                              content_type=resp.headers.get('Content-Type', 'text/event-stream'))
+            user_text = None
+            return events
+        
         # Process response and extract memories
         if resp.status_code == 200:
             try:
-                response_data = resp.json()
+                response_data = orjson.loads(resp.content)
                 
                 # Extract text from response
-                response_text = ""
-                if response_data.get('output'):
-                    for item in response_data['output']:
-                        if item.get('type') == 'message' and item.get('content'):
-                            for c in item['content']:
-                                if c.get('type') in ['output_text', 'text']:
-                                    response_text += c.get('text', '')
-                
-                # Store assistant response
-                if response_text:
-                    store_message(conn, thread_id, user_id, 'assistant', response_text[:2000])
-                    
-                    # Extract and store memories
-                    extract_memories_from_response(response_text, user_id, conn)
-                    
-                    # Create conversation summary (simple version)
-                    customer_ids = extract_customer_ids(response_text)
-                    if customer_ids:
-                        summary = f"Analyzed customers: {', '.join(customer_ids[:3])}"
-                        store_conversation_summary(conn, user_id, thread_id, summary, customer_ids)
+                response_text = "".join(
+                    c.get('text', '')
+                    for item in response_data.get('output') or []
+                    if item.get('type') == 'message' and item.get('content')
+                    for c in item['content']
+                    if c.get('type') in ('output_text', 'text')
+                )
                 
                 # Add memory indicator to response
                 custom_outputs = response_data.get('custom_outputs') or {}
                 custom_outputs['memory_enabled'] = True
-                custom_outputs['memory_storage'] = "lakebase" if conn else "in_memory"
+                custom_outputs['memory_storage'] = memory_storage
                 custom_outputs['thread_id'] = thread_id
                 custom_outputs['user_id'] = user_id
                 response_data['custom_outputs'] = custom_outputs
                 
-                if conn:
-                    conn.close()
+                # Store the turn and memories off the request path
+                _submit_persist(user_id, thread_id, user_text, response_text)
+                user_text = None
                 
                 return jsonify(response_data)
                 
             except Exception as e:
                 logger.error(f"Error processing response: {e}")
         
-        if conn:
-            conn.close()
+        # Keep the user's turn in the audit trail even without a usable reply
+        _submit_persist(user_id, thread_id, user_text, "")
+        user_text = None
         
-        return Response(resp.content, status=resp.status_code,
-                       content_type=resp.headers.get('Content-Type', 'application/json'))
+        # Pass the agent's body through chunk by chunk instead of buffering it
+        passthrough = Response(resp.iter_content(64 * 1024), status=resp.status_code,
+                               content_type=resp.headers.get('Content-Type', 'application/json'))
+        passthrough.call_on_close(resp.close)
+        return passthrough
         
     except Exception as e:
         logger.exception(f"Proxy error: {e}")
+        if user_text is not None:
+            _submit_persist(user_id, thread_id, user_text, "")
         return jsonify({"error": str(e)}), 500
 
 
 @app.route('/api/memory/user/<user_id>', methods=['GET'])
 def get_memories_api(user_id):
     """Get all memories for a user"""
-    conn = get_lakebase_connection()
-    if conn:
-        ensure_tables(conn)
-    
-    memories = get_user_memories(conn, user_id)
-    summaries = get_conversation_summaries(conn, user_id)
-    
-    storage_type = "lakebase" if conn else "in_memory"
-    
-    if conn:
-        conn.close()
+    with lakebase_connection() as conn:
+        memories, summaries = get_memory_snapshot(conn, user_id)
+        
+        storage_type = "lakebase" if conn else "in_memory"
     
     return jsonify({
         "user_id": user_id,
@@ -680,26 +1155,24 @@ def get_memories_api(user_id):
 @app.route('/api/memory/user/<user_id>/clear', methods=['POST'])
 def clear_memories_api(user_id):
     """Clear long-term memories for a user (keeps conversation history for audit)"""
-    conn = get_lakebase_connection()
-    
-    if conn:
-        ensure_tables(conn)
-        try:
-            with conn.cursor() as cur:
-                # Clear long-term memories only
-                cur.execute("DELETE FROM app_user_memories WHERE user_id = %s", (user_id,))
-                cur.execute("DELETE FROM app_conversation_summaries WHERE user_id = %s", (user_id,))
-                # NOTE: Keeping app_conversation_history for audit trail
-                conn.commit()
-            conn.close()
-            logger.info(f"Cleared long-term memories for user: {user_id} (history preserved)")
-        except Exception as e:
-            logger.error(f"Error clearing memories: {e}")
-            return jsonify({"error": str(e)}), 500
+    with lakebase_connection() as conn:
+        if conn:
+            try:
+                with conn.cursor() as cur:
+                    # Clear long-term memories only
+                    cur.execute("DELETE FROM app_user_memories WHERE user_id = %s", (user_id,))
+                    cur.execute("DELETE FROM app_conversation_summaries WHERE user_id = %s", (user_id,))
+                    # NOTE: Keeping app_conversation_history for audit trail
+                    conn.commit()
+                logger.info(f"Cleared long-term memories for user: {user_id} (history preserved)")
+            except Exception as e:
+                logger.error(f"Error clearing memories: {e}")
+                return jsonify({"error": str(e)}), 500
     
     # Clear cache too
     MEMORY_CACHE["user_memories"].pop(user_id, None)
     MEMORY_CACHE["summaries"].pop(user_id, None)
+    _invalidate_memory_context(user_id)
     
     return jsonify({"status": "cleared", "user_id": user_id, "history_preserved": True})
 
@@ -707,13 +1180,8 @@ def clear_memories_api(user_id):
 @app.route('/api/memory/thread/<thread_id>', methods=['GET'])
 def get_thread_history_api(thread_id):
     """Get conversation history for a thread"""
-    conn = get_lakebase_connection()
-    if conn:
-        ensure_tables(conn)
-    history = get_conversation_history(conn, thread_id)
-    
-    if conn:
-        conn.close()
+    with lakebase_connection() as conn:
+        history = get_conversation_history(conn, thread_id)
     
     return jsonify({
         "thread_id": thread_id,
@@ -724,46 +1192,41 @@ def get_thread_history_api(thread_id):
 @app.route('/api/memory/user/<user_id>/threads', methods=['GET'])
 def get_user_threads_api(user_id):
     """Get all conversation threads for a user"""
-    conn = get_lakebase_connection()
     threads = []
     
-    if conn:
-        ensure_tables(conn)
-        try:
-            with conn.cursor() as cur:
-                # Get distinct threads with their first message and timestamp
-                cur.execute("""
-                    SELECT DISTINCT ON (thread_id) 
-                        thread_id, 
-                        content,
-                        created_at,
-                        (SELECT COUNT(*) FROM app_conversation_history h2 WHERE h2.thread_id = h1.thread_id) as message_count
-                    FROM app_conversation_history h1
-                    WHERE user_id = %s AND role = 'user'
-                    ORDER BY thread_id, created_at ASC
-                """, (user_id,))
-                
-                rows = cur.fetchall()
-                for row in rows:
-                    threads.append({
-                        "thread_id": row[0],
-                        "first_message": row[1][:100] + "..." if len(row[1]) > 100 else row[1],
-                        "created_at": str(row[2]),
-                        "message_count": row[3]
-                    })
-                
-                # Sort by created_at descending (most recent first)
-                threads.sort(key=lambda x: x["created_at"], reverse=True)
-                
-            conn.close()
-        except Exception as e:
-            logger.error(f"Error getting threads: {e}")
-            if conn:
-                conn.close()
+    with lakebase_connection() as conn:
+        if conn:
+            try:
+                with conn.cursor() as cur:
+                    # One grouped pass: first user message, its timestamp and the message count
+                    # per thread, 20 most recent first (101 chars is enough to know it was cut)
+                    cur.execute("""
+                        SELECT
+                            thread_id,
+                            (array_agg(LEFT(content, 101) ORDER BY created_at) FILTER (WHERE role = 'user'))[1] AS first_message,
+                            MIN(created_at) FILTER (WHERE role = 'user') AS first_ts,
+                            COUNT(*) AS message_count
+                        FROM app_conversation_history
+                        WHERE user_id = %s
+                        GROUP BY thread_id
+                        HAVING COUNT(*) FILTER (WHERE role = 'user') > 0
+                        ORDER BY first_ts DESC
+                        LIMIT 20
+                    """, (user_id,))
+                    
+                    for row in cur.fetchall():
+                        threads.append({
+                            "thread_id": row[0],
+                            "first_message": row[1][:100] + "..." if len(row[1]) > 100 else row[1],
+                            "created_at": str(row[2]),
+                            "message_count": row[3]
+                        })
+            except Exception as e:
+                logger.error(f"Error getting threads: {e}")
     
     return jsonify({
         "user_id": user_id,
-        "threads": threads[:20]  # Limit to 20 most recent
+        "threads": threads
     })
 
 
@@ -772,12 +1235,8 @@ def health():
     # Test Lakebase connection
     lakebase_status = "unknown"
     try:
-        conn = get_lakebase_connection()
-        if conn:
-            lakebase_status = "connected"
-            conn.close()
-        else:
-            lakebase_status = "fallback_to_memory"
+        with lakebase_connection() as conn:
+            lakebase_status = "connected" if conn else "fallback_to_memory"
     except Exception as e:
         lakebase_status = f"error: {str(e)[:50]}"
     
@@ -792,11 +1251,16 @@ def health():
 
 @app.route('/<path:path>')
 def serve_static(path):
-    file_path = os.path.join(DIST_DIR, path)
-    if os.path.exists(file_path):
-        return send_from_directory(DIST_DIR, path)
+    if path in DIST_FILES:
+        resp = send_from_directory(DIST_DIR, path)
+        if path.startswith(HASHED_ASSETS_PREFIX):
+            # Browsers and CDNs keep fingerprinted files without revalidating
+            resp.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        return resp
+    # index.html keeps Flask's default no-cache so a new build is picked up on the next load
     return send_from_directory(DIST_DIR, 'index.html')
 
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.getenv('PORT', 8000)), debug=True)
+    # Reloader and debugger only on request (FLASK_DEBUG=1) - production runs under gunicorn
+    app.run(host='0.0.0.0', port=int(os.getenv('DATABRICKS_APP_PORT') or os.getenv('PORT', 8000)), debug=os.getenv('FLASK_DEBUG', '0') == '1')
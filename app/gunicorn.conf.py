@@ -0,0 +1,13 @@
+"""Gunicorn settings for the deployed app (app.yaml runs `gunicorn --config gunicorn.conf.py app:app`)"""
+import os
+
+# Databricks Apps hands the port to the app; PORT keeps parity with `python app.py`
+bind = f"0.0.0.0:{os.getenv('DATABRICKS_APP_PORT') or os.getenv('PORT', '8000')}"
+
+# One process: the memory-context cache, duplicate-response tracking and the in-memory fallback
+# are per process, and the work is I/O-bound, so threads - not processes - carry the concurrency.
+# 6 request threads + 4 background writers (_bg_executor) = LAKEBASE_POOL_MAX connections.
+worker_class = "gthread"
+workers = 1
+threads = 6
+timeout = 180
@@ -111,8 +111,11 @@ CREATE TABLE IF NOT EXISTS app_conversation_history (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_conv_thread ON app_conversation_history(thread_id);
-CREATE INDEX IF NOT EXISTS idx_conv_user ON app_conversation_history(user_id);
+CREATE INDEX IF NOT EXISTS idx_hist_thread_created ON app_conversation_history(thread_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_hist_user_created ON app_conversation_history(user_id, created_at DESC);
+-- Single-column indexes from earlier versions, now covered by the composite indexes
+DROP INDEX IF EXISTS idx_conv_thread;
+DROP INDEX IF EXISTS idx_conv_user;
 
 -- User memories (long-term learned facts)
 CREATE TABLE IF NOT EXISTS app_user_memories (
@@ -127,7 +130,8 @@ CREATE TABLE IF NOT EXISTS app_user_memories (
     UNIQUE(user_id, memory_type, memory_key)
 );
 
-CREATE INDEX IF NOT EXISTS idx_mem_user ON app_user_memories(user_id);
+CREATE INDEX IF NOT EXISTS idx_mem_user_updated ON app_user_memories(user_id, updated_at DESC);
+DROP INDEX IF EXISTS idx_mem_user;
 
 -- Conversation summaries (thread context)
 CREATE TABLE IF NOT EXISTS app_conversation_summaries (
@@ -141,7 +145,8 @@ CREATE TABLE IF NOT EXISTS app_conversation_summaries (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_sum_user ON app_conversation_summaries(user_id);
+CREATE INDEX IF NOT EXISTS idx_sum_user_created ON app_conversation_summaries(user_id, created_at DESC);
+DROP INDEX IF EXISTS idx_sum_user;
 """
 
     print("  SQL to execute in Lakebase:")